@@ -2,17 +2,32 @@ import asyncio
 from argparse import ArgumentParser
 import concurrent.futures
 from configparser import ConfigParser
+from fractions import Fraction
 import logging
 import os
 import signal
 import sys
 
+from dropbox import Dropbox, create_session
+from picamera.mmalobj import to_resolution
 import systemd.journal
+from urllib3.util.retry import Retry
 import xdg
 
-from kanikamera.camera import StillImageManager, VideoManager
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+from kanikamera.camera import Camera, StillImageManager, VideoManager
 from kanikamera.motionsensor import MotionSensor
 
+_UPLOAD_THREADS = 2
+
+_CONFIG_PATHS = [
+    os.path.join(path, "kanikamera") for path in
+    reversed([xdg.XDG_CONFIG_HOME] + xdg.XDG_CONFIG_DIRS)]
+
 
 def parse_args():
     parser = ArgumentParser(description="Kanimakera service")
@@ -32,8 +47,7 @@ def init_logging(args):
 
 def get_config():
     config = ConfigParser()
-    paths = [xdg.XDG_CONFIG_HOME] + xdg.XDG_CONFIG_DIRS
-    config.read(os.path.join(path, "kanikamera") for path in reversed(paths))
+    config.read(_CONFIG_PATHS)
     return config
 
 
@@ -43,6 +57,55 @@ def init_config_dict(config, key):
     return {}
 
 
+def parse_boolean(value):
+    try:
+        return ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("Not a boolean: %r" % value)
+
+
+def parse_framerate_range(value):
+    low, high = value.split(",")
+    return Fraction(low), Fraction(high)
+
+
+_CAMERA_CONFIG_TYPES = {
+    "camera_num": int,
+    "framerate": Fraction,
+    "framerate_range": parse_framerate_range,
+    "led_pin": int,
+    "resolution": to_resolution,
+    "sensor_mode": int,
+    "stereo_decimate": parse_boolean,
+}
+
+
+def init_camera_config(config):
+    camera_config = init_config_dict(config, "Camera")
+    for key, type_ in _CAMERA_CONFIG_TYPES.items():
+        if key in camera_config:
+            camera_config[key] = type_(camera_config[key])
+    return camera_config
+
+
+def parse_quality(value):
+    quality = int(value)
+    if not 1 <= quality <= 100:
+        raise ValueError("JPEG quality must be between 1 and 100: %r" % value)
+    return quality
+
+
+def init_dropbox(token):
+    # A single client keeps its HTTPS connections alive between uploads, with
+    # one pooled connection for each upload thread. Only failed connection
+    # attempts are retried, because nothing has been sent yet. Any other
+    # failure may have reached Dropbox and is left to the caller.
+    session = create_session(max_connections=_UPLOAD_THREADS)
+    session.get_adapter("https://").max_retries = Retry(
+        connect=3, read=False, redirect=False, other=0, backoff_factor=0.5)
+    return Dropbox(token, session=session)
+
+
 def terminate(loop):
     async def do_terminate():
         current_task = asyncio.Task.current_task(loop=loop)
@@ -67,26 +130,53 @@ def main():
     except KeyError:
         logging.fatal("Dropbox authentication token not found. Exiting.")
         sys.exit(1)
-    camera_config = init_config_dict(config, "Camera")
+    dropbox = init_dropbox(token)
+    # Uploads get their own threads so that a slow upload does not hold up
+    # the camera work in the default executor
+    upload_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=_UPLOAD_THREADS)
+    try:
+        camera = Camera(init_camera_config(config))
+    except ValueError:
+        logging.fatal("Invalid camera configuration. Exiting.")
+        sys.exit(1)
     motion_sensor_config = init_config_dict(config, "MotionSensor")
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    loop = asyncio.get_event_loop()
 
     still_image_config = init_config_dict(config, "StillImage")
     interval = float(still_image_config.pop("interval", 300))
-    still_image_manager = StillImageManager(token, camera_config, interval)
+    try:
+        quality = parse_quality(still_image_config.pop("quality", 80))
+    except ValueError:
+        logging.fatal("Invalid still image quality. Exiting.")
+        sys.exit(1)
+    still_image_manager = StillImageManager(
+        dropbox, upload_executor, camera, loop, interval, quality)
 
     video_config = init_config_dict(config, "Video")
     motionless_period = float(video_config.pop("motionless_period", 1800))
     video_duration = float(video_config.pop("video_duration", 60))
     video_manager = VideoManager(
-        token, camera_config, motionless_period, video_duration)
+        dropbox, upload_executor, camera, loop, motionless_period,
+        video_duration)
+
+    try:
+        motion_sensor = MotionSensor(motion_sensor_config, loop)
+    except (OSError, ValueError) as e:
+        logging.fatal("Could not set up the motion sensor: %s. Exiting.", e)
+        sys.exit(1)
 
-    loop = asyncio.get_event_loop()
     loop.add_signal_handler(signal.SIGTERM, terminate, loop)
     loop.add_signal_handler(signal.SIGINT, terminate, loop)
     loop.create_task(still_image_manager())
 
-    with concurrent.futures.ThreadPoolExecutor() as executor, \
-         MotionSensor(motion_sensor_config, loop) as motion_sensor:
+    # The default executor only runs camera work, which is serialized by the
+    # camera lock anyway
+    with camera, upload_executor, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor, \
+         motion_sensor:
         loop.set_default_executor(executor)
         loop.create_task(
             video_manager(
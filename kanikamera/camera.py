@@ -4,26 +4,173 @@ This module contains manager classes for capturing still images and video in
 response to events. The exposed interface is coroutines that can be attached to
 event loop.
 
-Todo:
-    Do not block in the event loop when capturing/converting/uploading
-    images/videos.
+Capturing, converting and uploading never block the event loop. Camera work
+runs in the default executor, ffmpeg runs as a subprocess and uploads run in a
+dedicated upload executor.
 """
 
 import asyncio
 import contextlib
-from datetime import datetime
+from datetime import datetime, timedelta
 import functools
 from io import BytesIO
 import logging
-import subprocess
+import os
 from tempfile import NamedTemporaryFile
-from time import localtime
+import threading
 
-from dropbox import Dropbox
 from dropbox.exceptions import DropboxException
+from dropbox.files import CommitInfo, UploadSessionCursor
 from picamera import PiCamera, PiCameraError
 from requests.exceptions import RequestException
 
+logger = logging.getLogger(__name__)
+
+_UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+_VIDEO_PORT_MAX_RESOLUTION = (1920, 1080)
+_OFFICE_HOURS_CHECK_PERIOD = 60
+_SPOOL_POLL_PERIOD = 0.5
+
+
+def _seconds_until_office_hours():
+    now = datetime.now()
+    if now.weekday() < 5 and 9 <= now.hour < 17:
+        return 0
+    start = now.replace(hour=9, minute=0, second=0, microsecond=0)
+    if now.hour >= 9:
+        start += timedelta(days=1)
+    while start.weekday() >= 5:
+        start += timedelta(days=1)
+    return (start - now).total_seconds()
+
+
+async def _wait_for_office_hours(camera):
+    delay = _seconds_until_office_hours()
+    if delay:
+        logger.debug("Sleeping %r seconds until office hours", delay)
+        await camera.suspend()
+        # asyncio.sleep follows the monotonic clock, so a long sleep would miss
+        # the wall clock being corrected by NTP or moved by DST. Sleeping in
+        # short steps rechecks the wall clock every now and then.
+        while delay:
+            await asyncio.sleep(min(delay, _OFFICE_HOURS_CHECK_PERIOD))
+            delay = _seconds_until_office_hours()
+
+
+async def _wait_for_executor(future):
+    # Cancelling the awaiting task would only cancel the wrapper of an executor
+    # future, not the work in the executor thread. The work is waited for
+    # anyway, so that the files it uses are not closed under it.
+    cancelled = False
+    while not future.done():
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError()
+    return future.result()
+
+
+class _GrowingFile:
+    # Read end of a file that another process is still writing to. Reads
+    # block until the requested amount is available or the writer is done.
+
+    def __init__(self, f, done):
+        self._f = f
+        self._done = done
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            # Checking before reading ensures that the data written before the
+            # writer was done is still read
+            done = self._done.is_set()
+            chunk = self._f.read(size)
+            if chunk:
+                chunks.append(chunk)
+                size -= len(chunk)
+            elif done:
+                break
+            else:
+                self._done.wait(_SPOOL_POLL_PERIOD)
+        return b"".join(chunks)
+
+
+class Camera:
+    """Camera shared by the image managers
+
+    The underlying :class:`picamera.PiCamera` is opened on first use and kept
+    open until :func:`close` is called. This spares the camera initialization
+    on every capture and lets the automatic exposure and white balance stay
+    converged between captures. If the camera fails, it is reopened on next
+    use.
+
+    The class defines asynchronous context manager that acquires exclusive
+    access to the camera. Because a lock is acquired, the critical section
+    should be as small as possible.
+
+    This class also defines context manager and can be used in with statement
+    ensuring that :func:`close` is called.
+    """
+
+    def __init__(self, camera_config):
+        """Initialize camera
+
+        Args:
+            camera_config: dictionary of configuration values for the camera
+                module
+        """
+        self.config = camera_config
+        self._camera = None
+        self._lock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    async def __aenter__(self):
+        await self._get_lock().acquire()
+        try:
+            if not self._camera:
+                self._camera = PiCamera(**self.config)
+            return self._camera
+        except:
+            self._lock.release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type and issubclass(exc_type, PiCameraError):
+                self.close()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close the camera"""
+        if self._camera:
+            self._camera.close()
+            self._camera = None
+
+    async def suspend(self):
+        """Close the camera once it is no longer in use
+
+        Unlike :func:`close`, this waits for exclusive access to the camera, so
+        that a capture in progress is not interrupted. The camera is reopened
+        on next use.
+        """
+        async with self._get_lock():
+            self.close()
+
+    def _get_lock(self):
+        # The lock is created on first use so that it belongs to the running
+        # event loop
+        if not self._lock:
+            self._lock = asyncio.Lock()
+        return self._lock
+
 
 class ImageManagerBase:
     """Base class for image manager
@@ -31,76 +178,115 @@ class ImageManagerBase:
     Offers image capture and upload as services for the derived classes.
     """
 
-    _camera_lock = asyncio.Lock()
-
-    def __init__(self, token, camera_config):
+    def __init__(self, dropbox, upload_executor, camera, loop):
         """Initialize image manager base
 
         Args:
-            token: Dropbox token for uploading images
-            camera_config: dictionary of configuration values for the camera
-                module
+            dropbox: :class:`dropbox.Dropbox` client for uploading images
+            upload_executor: executor running the uploads
+            camera: the shared :class:`Camera`
+            loop: the event loop
         """
-        self._token = token
-        self._camera_config = camera_config
+        self._dropbox = dropbox
+        self._upload_executor = upload_executor
+        self._camera = camera
+        self._loop = loop
+        self._upload_date = None
+        self._upload_folder = None
 
-    @classmethod
-    def captures_image(cls, func):
+    @staticmethod
+    def captures_image(func):
         """Decorate method that captures image using camera
 
         The decorator takes care of observing that images are only captured
-        during office hours, then calls the decorated function with a factory
-        method that can be used as asynchronous context manager to acquire lock
-        for and initialize the camera. Because a lock is acquired, the critical
-        section should be as small as possible.
+        during office hours, then calls the decorated function. The decorated
+        function uses the shared :class:`Camera` as asynchronous context
+        manager to acquire the camera.
         """
         @functools.wraps(func)
-        def capture_with_camera(self, *args, **kwargs):
-            now = localtime()
-            if now.tm_hour < 9 or now.tm_hour >= 17 or now.tm_wday >= 5:
-                logging.debug(
-                    "%r requested to capture image/video %r but it's not office hours",
+        async def capture_with_camera(self, *args, **kwargs):
+            if _seconds_until_office_hours():
+                logger.debug(
+                    "%r requested to capture image/video but it's not office hours",
                     func.__name__)
                 return
-            camera_config = self._camera_config
-            class Camera:
-                def __init__(self):
-                    self._camera = None
-                async def __aenter__(self):
-                    try:
-                        await cls._camera_lock.acquire()
-                        self._camera = PiCamera(**_camera_config)
-                        return self._camera
-                    except:
-                        cls._camera_lock.release()
-                        raise
-                async def __aexit__(self, exc_type, exc, tb):
-                    self._camera.close()
-                    cls._camera_lock.release()
             try:
-                return func(self, Camera, *args, **kwargs)
+                return await func(self, *args, **kwargs)
             except PiCameraError:
-                logging.exception("PiCamera failure")
+                logger.exception("PiCamera failure")
         return capture_with_camera
 
-    async def upload_image(self, format, img):
+    async def upload_image(self, format, img, timestamp=None):
         """Upload image to Dropbox
 
         Args:
             format: file extension for the uploaded file
             img: the contents (bytes) of the image
+            timestamp: the :class:`datetime.datetime` the file is named after,
+                by default the current time
         """
-        now = datetime.now()
-        upload_file = "/Kanikuvat/{}/{}.{}".format(
-            now.strftime("%Y%m%d"), now.strftime("%H%M%S"), format)
+        upload_file = self._get_upload_file(format, timestamp)
         def do_upload_image():
-            logging.debug("Uploading image to Dropbox, file: %r", upload_file)
+            logger.debug("Uploading image to Dropbox, file: %r", upload_file)
+            try:
+                self._dropbox.files_upload(img, upload_file)
+            except (DropboxException, RequestException):
+                logger.exception("Dropbox failure")
+        await self._loop.run_in_executor(self._upload_executor, do_upload_image)
+
+    def upload_image_file(self, format, f):
+        """Upload image from file to Dropbox
+
+        The file is read and uploaded in chunks using an upload session, so
+        that only one chunk at a time is held in memory. The file may also
+        still be growing, in which case the chunks are uploaded as they are
+        written to it. Nothing is uploaded if the file is empty.
+
+        Unlike :func:`upload_image`, this returns the future of the upload
+        running in the upload executor. Cancelling the future does not stop
+        the upload, so the caller must keep the file open until the upload is
+        done.
+
+        Args:
+            format: file extension for the uploaded file
+            f: binary file object to read the contents of the image from
+
+        Returns:
+            awaitable future for the completion of the upload
+        """
+        upload_file = self._get_upload_file(format)
+        def do_upload_image_file():
+            logger.debug("Uploading image to Dropbox in chunks, file: %r", upload_file)
             try:
-                dropbox = Dropbox(self._token)
-                dropbox.files_upload(img, upload_file)
+                chunk = f.read(_UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    logger.warning("Not uploading empty file: %r", upload_file)
+                    return
+                if len(chunk) < _UPLOAD_CHUNK_SIZE:
+                    self._dropbox.files_upload(chunk, upload_file)
+                    return
+                session = self._dropbox.files_upload_session_start(chunk)
+                cursor = UploadSessionCursor(session.session_id, len(chunk))
+                chunk = f.read(_UPLOAD_CHUNK_SIZE)
+                while len(chunk) == _UPLOAD_CHUNK_SIZE:
+                    self._dropbox.files_upload_session_append_v2(chunk, cursor)
+                    cursor.offset += len(chunk)
+                    chunk = f.read(_UPLOAD_CHUNK_SIZE)
+                self._dropbox.files_upload_session_finish(
+                    chunk, cursor, CommitInfo(upload_file))
             except (DropboxException, RequestException):
-                logging.exception("Dropbox failure")
-        await asyncio.get_event_loop().run_in_executor(None, do_upload_image)
+                logger.exception("Dropbox failure")
+        return self._loop.run_in_executor(
+            self._upload_executor, do_upload_image_file)
+
+    def _get_upload_file(self, format, timestamp=None):
+        now = timestamp or datetime.now()
+        date = now.date()
+        if date != self._upload_date:
+            self._upload_date = date
+            self._upload_folder = now.strftime("/Kanikuvat/%Y%m%d/")
+        return "%s%02d%02d%02d.%s" % (
+            self._upload_folder, now.hour, now.minute, now.second, format)
 
 
 class StillImageManager(ImageManagerBase):
@@ -109,33 +295,83 @@ class StillImageManager(ImageManagerBase):
     Still images are taken in regular intervals.
     """
 
-    def __init__(self, token, camera_config, interval):
+    def __init__(self, dropbox, upload_executor, camera, loop, interval, quality):
         """Initialize the manager
 
         Args:
-            token: Dropbox token for uploading images
-            camera_config: dictionary of configuration values for the camera
-                module
+            dropbox: :class:`dropbox.Dropbox` client for uploading images
+            upload_executor: executor running the uploads
+            camera: the shared :class:`Camera`
+            loop: the event loop
             interval: the capture interval in seconds
+            quality: the JPEG quality (1-100) of the captured images
         """
-        super(StillImageManager, self).__init__(token, camera_config)
+        super(StillImageManager, self).__init__(
+            dropbox, upload_executor, camera, loop)
         self._interval = interval
+        self._quality = quality
+        self._upload_queue = None
 
     async def __call__(self):
-        """Generate coroutine that takes periodic photos when attached to event loop"""
+        """Generate coroutine that takes periodic photos when attached to event loop
+
+        The photos are uploaded by a separate task, so that slow uploads do not
+        delay the captures.
+        """
+        loop = self._loop
+        self._upload_queue = asyncio.Queue(maxsize=4)
+        uploader = loop.create_task(self._upload_still_images())
+        try:
+            with contextlib.suppress(asyncio.CancelledError):
+                while not asyncio.Task.current_task().cancelled():
+                    await _wait_for_office_hours(self._camera)
+                    tic = loop.time()
+                    await self._capture_still_image()
+                    # The time spent capturing counts towards the interval
+                    await asyncio.sleep(
+                        max(self._interval + tic - loop.time(), 0))
+        finally:
+            uploader.cancel()
+
+    async def _upload_still_images(self):
         with contextlib.suppress(asyncio.CancelledError):
-            while not asyncio.Task.current_task().cancelled():
-                await self._capture_still_image()
-                await asyncio.sleep(self._interval)
+            while True:
+                timestamp, img = await self._upload_queue.get()
+                # A failed upload must not end the uploader, or the queue
+                # would never be drained again
+                try:
+                    await self.upload_image("jpg", img, timestamp)
+                except Exception:
+                    logger.exception("Failed to upload still image")
 
     @ImageManagerBase.captures_image
-    async def _capture_still_image(self, Camera):
-        logging.debug("Capturing still image, config: %r", self._camera_config)
+    async def _capture_still_image(self):
+        logger.debug("Capturing still image, config: %r", self._camera.config)
         with BytesIO() as img:
-            async with Camera() as camera:
-                await asyncio.get_event_loop().run_in_executor(
-                    None, functools.partial(camera.capture, img, format="jpeg"))
-            await self.upload_image("jpg", img.getvalue())
+            async with self._camera as camera:
+                # Capturing from the video port avoids switching the sensor to
+                # the still mode for every image, but it is limited to full HD.
+                # Skipping the EXIF thumbnail saves the encoder a second pass
+                # per capture.
+                max_width, max_height = _VIDEO_PORT_MAX_RESOLUTION
+                use_video_port = (
+                    camera.resolution.width <= max_width and
+                    camera.resolution.height <= max_height)
+                await self._loop.run_in_executor(
+                    None, functools.partial(
+                        camera.capture, img, format="jpeg",
+                        use_video_port=use_video_port, quality=self._quality,
+                        thumbnail=None))
+            if not img.tell():
+                logger.warning("Camera produced an empty image")
+                return
+            # If the uploads have fallen behind, the oldest image is dropped to
+            # bound the memory used by the queue.
+            if self._upload_queue.full():
+                logger.warning(
+                    "Uploads are falling behind. Dropping oldest image.")
+                self._upload_queue.get_nowait()
+            self._upload_queue.put_nowait((datetime.now(), img.getvalue()))
 
 
 class VideoManager(ImageManagerBase):
@@ -144,18 +380,21 @@ class VideoManager(ImageManagerBase):
     Video is captured when motion is detected, if there hasn't been any motion
     in a while as defined by an user supplied parameter."""
 
-    def __init__(self, token, camera_config, motionless_period, video_duration):
+    def __init__(self, dropbox, upload_executor, camera, loop,
+                 motionless_period, video_duration):
         """Initialize the manager
 
         Args:
-            token: Dropbox token for uploading images
-            camera_config: dictionary of configuration values for the camera
-                module
+            dropbox: :class:`dropbox.Dropbox` client for uploading images
+            upload_executor: executor running the uploads
+            camera: the shared :class:`Camera`
+            loop: the event loop
             motionless_period: period in second that there must be no motion in
                 order for video capture to start
             video_duration: the duration of the captured video in seconds
         """
-        super(VideoManager, self).__init__(token, camera_config)
+        super(VideoManager, self).__init__(
+            dropbox, upload_executor, camera, loop)
         self._motionless_period = motionless_period
         self._video_duration = video_duration
         self._last_motion_time = None
@@ -169,14 +408,15 @@ class VideoManager(ImageManagerBase):
         """
         with contextlib.suppress(asyncio.CancelledError):
             while not asyncio.Task.current_task().cancelled():
-                logging.debug("Waiting to detect motion")
+                await _wait_for_office_hours(self._camera)
+                logger.debug("Waiting to detect motion")
                 await motion_detect_event.wait()
                 await self._handle_motion_detected()
                 await motion_stop_event.wait()
 
     async def _handle_motion_detected(self):
-        motion_time = asyncio.get_event_loop().time()
-        logging.debug(
+        motion_time = self._loop.time()
+        logger.debug(
             "Motion detected at %r. Last was: %r",
             motion_time, self._last_motion_time)
         if (not self._last_motion_time or
@@ -186,27 +426,74 @@ class VideoManager(ImageManagerBase):
 
     def _record_video(self, camera, f):
         camera.start_recording(f, format="h264")
-        camera.wait_recording(self._video_duration)
-        camera.stop_recording()
+        try:
+            camera.wait_recording(self._video_duration)
+        finally:
+            camera.stop_recording()
 
     @ImageManagerBase.captures_image
-    async def _capture_video(self, Camera):
-        logging.debug("Capturing video, config: %r", self._camera_config)
-        loop = asyncio.get_event_loop()
-        with NamedTemporaryFile() as tmpdbx:
-            # This might be considered abusing the synchronous subprocess API in
-            # asynchronous code. The asyncio subprocess API makes it tedious to
-            # write to the pipe feeding avconv its input from the thread running
-            # the camera.
-            async with Camera() as camera:
-                args = ["avconv", "-y", "-r", str(camera.framerate),
-                        "-i", "pipe:0", "-f", "mp4", tmpdbx.name]
-                logging.debug("Calling avconv with args: %r", args)
-                p = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
-                await loop.run_in_executor(None, self._record_video, camera, p.stdin)
-            _, err = await loop.run_in_executor(None, p.communicate)
-            if p.returncode == 0:
-                tmpdbx.seek(0)
-                await self.upload_image("mp4", tmpdbx.read())
-            else:
-                logging.warn("Converting video failed: %r", err)
+    async def _capture_video(self):
+        logger.debug("Capturing video, config: %r", self._camera.config)
+        loop = self._loop
+        # The camera writes the H.264 stream to ffmpeg through a pipe, and the
+        # fragmented MP4 output of ffmpeg is spooled to a temporary file that
+        # is uploaded while it grows. The spool decouples the recording from
+        # the uplink, so a slow upload never blocks the camera. ffmpeg treats
+        # pipe:1 as a stream even when it is a regular file, so it never seeks
+        # back to rewrite what has already been uploaded.
+        #
+        # Recording and uploading run in executor threads. If recording fails
+        # or is cancelled, ffmpeg is killed, which also stops the recording.
+        # The threads are always waited for before the files are closed.
+        video_r, video_w = os.pipe()
+        with open(video_r, "rb", buffering=0) as ffmpeg_stdin, \
+             open(video_w, "wb", buffering=0) as video, \
+             NamedTemporaryFile(prefix="kanikamera-") as ffmpeg_stdout, \
+             open(ffmpeg_stdout.name, "rb", buffering=0) as spool:
+            ffmpeg_done = threading.Event()
+            p = None
+            upload = None
+            try:
+                async with self._camera as camera:
+                    # The camera already encodes H.264, so ffmpeg only needs to
+                    # copy the stream into the MP4 container. The raw stream
+                    # has no timestamps, so they are generated from the frame
+                    # rate.
+                    args = ["ffmpeg", "-y", "-fflags", "+genpts",
+                            "-r", str(camera.framerate),
+                            "-f", "h264", "-i", "pipe:0", "-c:v", "copy",
+                            "-movflags", "+frag_keyframe+empty_moov",
+                            "-f", "mp4", "pipe:1"]
+                    logger.debug("Calling ffmpeg with args: %r", args)
+                    p = await asyncio.create_subprocess_exec(
+                        *args, stdin=ffmpeg_stdin, stdout=ffmpeg_stdout,
+                        stderr=asyncio.subprocess.PIPE)
+                    ffmpeg_stdin.close()
+                    upload = self.upload_image_file(
+                        "mp4", _GrowingFile(spool, ffmpeg_done))
+                    record = loop.run_in_executor(
+                        None, self._record_video, camera, video)
+                    try:
+                        await asyncio.shield(record)
+                    except BrokenPipeError:
+                        logger.warning("ffmpeg stopped reading the video")
+                    except:
+                        with contextlib.suppress(ProcessLookupError):
+                            p.kill()
+                        with contextlib.suppress(Exception):
+                            await _wait_for_executor(record)
+                        raise
+                    video.close()
+                _, err = await p.communicate()
+            except:
+                if p and p.returncode is None:
+                    with contextlib.suppress(ProcessLookupError):
+                        p.kill()
+                    await p.wait()
+                raise
+            finally:
+                ffmpeg_done.set()
+                if upload:
+                    await _wait_for_executor(upload)
+        if p.returncode != 0:
+            logger.warning("Converting video failed: %r", err)
@@ -3,18 +3,21 @@
 import asyncio
 import logging
 
-import RPi.GPIO as GPIO
+import gpiod
+
+_GPIO_CHIP = "gpiochip0"
+_DEBOUNCE_PERIOD = 0.2
 
 
 class MotionSensor:
     """Class for controlling motion sensor
 
-    The class exports the necessary GPIO reserved for the sensor and is
+    The class requests the GPIO line reserved for the sensor and is
     responsible for generating events when the sensor detects motion.
 
-    Motion detection runs in a separate thread allocated by the
-    :class:`RPi.GPIO` library. The interface this class provides for the event
-    loop is an event object.
+    Edges are read from the GPIO character device, whose file descriptor is
+    watched by the event loop, so no separate thread is needed. The interface
+    this class provides for the event loop is an event object.
 
     This class defines context manager and can be used in with statement
     ensuring that :func:`close` is called.
@@ -35,10 +38,16 @@ class MotionSensor:
             self._loop = loop
             self._motion_detect_event = asyncio.Event(loop=loop)
             self._motion_stop_event = asyncio.Event(loop=loop)
-            GPIO.setmode(GPIO.BCM)
-            GPIO.setup(self.gpio, GPIO.IN)
-            GPIO.add_event_detect(self.gpio, GPIO.RISING)
-            GPIO.add_event_callback(self.gpio, self._handle_motion_detected)
+            self._debounce_handle = None
+            self._chip = gpiod.Chip(_GPIO_CHIP)
+            try:
+                self._line = self._chip.get_line(self.gpio)
+                self._line.request(
+                    consumer="kanikamera", type=gpiod.LINE_REQ_EV_BOTH_EDGES)
+                loop.add_reader(self._line.event_get_fd(), self._handle_edges)
+            except:
+                self._chip.close()
+                raise
         else:
             self.gpio = None
 
@@ -51,9 +60,13 @@ class MotionSensor:
     def close(self):
         """Perform cleanup
 
-        This method cleans up the motion sensor GPIO."""
+        This method releases the motion sensor GPIO."""
         if self.gpio:
-            GPIO.cleanup(self.gpio)
+            self._loop.remove_reader(self._line.event_get_fd())
+            if self._debounce_handle:
+                self._debounce_handle.cancel()
+            self._line.release()
+            self._chip.close()
 
     @property
     def motion_detect_event(self):
@@ -75,14 +88,21 @@ class MotionSensor:
         """
         return self._motion_stop_event
 
-    def _handle_motion_detected(self, gpio):
-        # Ideally we would like to detect the motion by polling POLLPRI on the
-        # GPIO file descriptor, making the additional event thread spawned by
-        # the RPi.GPIO library unnecessary. asyncio does not support POLLPRI,
-        # however.
-        if GPIO.input(gpio):
-            self._loop.call_soon_threadsafe(self._motion_detect_event.set)
-            self._loop.call_soon_threadsafe(self._motion_stop_event.clear)
+    def _handle_edges(self):
+        # Reading the edges clears the readiness of the file descriptor. The
+        # level of the line is only read once it has been stable for the
+        # debounce period, so a burst of edges results in a single update.
+        self._line.event_read_multiple()
+        if self._debounce_handle:
+            self._debounce_handle.cancel()
+        self._debounce_handle = self._loop.call_later(
+            _DEBOUNCE_PERIOD, self._handle_motion_detected)
+
+    def _handle_motion_detected(self):
+        self._debounce_handle = None
+        if self._line.get_value():
+            self._motion_detect_event.set()
+            self._motion_stop_event.clear()
         else:
-            self._loop.call_soon_threadsafe(self._motion_detect_event.clear)
-            self._loop.call_soon_threadsafe(self._motion_stop_event.set)
+            self._motion_detect_event.clear()
+            self._motion_stop_event.set()
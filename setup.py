@@ -12,9 +12,12 @@ setup(
     },
     install_requires=[
         "dropbox>=7.1",
-        "picamera>=1.12",
+        "picamera>=1.13",
         "xdg>=1.0",
         "systemd-python",
-        "RPi.GPIO>=0.6"
+        "urllib3>=1.26"
     ],
+    extras_require={
+        "uvloop": ["uvloop"],
+    },
 )